@@ -42,13 +42,18 @@ class BasicAI(PlayerBase):
         partial_score = sum(f.score() for f in claimed)
         self.debug.write("potential score %d\n" % partial_score)
 
+        sandbox = self.interface.sandbox()
+        if self.interface.option('dedup-placements'):
+            possible = [c[0] for c in sandbox.placement_classes(tile, possible)]
         for (x, y, rotate) in possible:
             self.debug.write("possible move %s\n" % ((x, y, rotate),))
-            sandbox = self.interface.sandbox()
             placement_score = 0
             placement_feature_score = 0
             placement_feature = None
-            for feature in sandbox.place(tile.rotate(rotate), x, y):
+            tile_features, token = sandbox.place(tile.rotate(rotate), x, y,
+                                                 undoable=True)
+            tile_features = sandbox.resolve_farms(tile_features)
+            for feature in tile_features:
                 self.debug.write("\tfeature %s %s\n" % (feature, feature.owners))
 
                 #if we already own the feature
@@ -144,6 +149,7 @@ class BasicAI(PlayerBase):
                                 elif feature0.owners:
                                     placement_score -= 1
 
+            sandbox.undo(token)
 
             placement_score += placement_feature_score
             self.debug.write("\tscore for placement %s\n" % placement_score)
@@ -0,0 +1,77 @@
+"""
+Optional numpy-backed mirror of the tiles in a :class:`world.World`.
+
+The world's tile dictionary remains the authoritative store; when the
+array-board option is enabled the world additionally writes the edges of each
+placed tile into dense arrays, so that the legal placements of a tile type
+across the whole frontier can be found in a handful of array operations
+rather than one cell and one rotation at a time.
+"""
+try:
+    import numpy
+    HAVE_NUMPY = True
+except ImportError:
+    numpy = None
+    HAVE_NUMPY = False
+
+NO_TILE = -1
+
+class ArrayBoard(object):
+    """
+    The edge codes of every placed tile, held as an int8 array with one
+    (2*extent+1)-square plane per side (N, E, S, W), and NO_TILE in empty
+    cells. Cell (x, y) is at [side, x+extent, y+extent]; the outermost ring is
+    never written, so the neighbours of any cell inside the extent can be read
+    without bounds checks.
+    """
+    def __init__(self, extent):
+        assert HAVE_NUMPY, "The array board requires numpy"
+        self.extent = extent
+        size = 2 * extent + 1
+        self.edges = numpy.full((4, size, size), NO_TILE, dtype=numpy.int8)
+
+    def set_tile(self, x, y, edges):
+        self.edges[:, x + self.extent, y + self.extent] = edges
+
+    def clear_tile(self, x, y):
+        self.edges[:, x + self.extent, y + self.extent] = NO_TILE
+
+    def constraints(self, cells):
+        """
+        Return a (4, len(cells)) array of the edges the neighbours present to
+        each (x, y) cell, in the manner of World.constraint but with NO_TILE
+        in place of None.
+        """
+        xs = numpy.array([c[0] for c in cells], dtype=numpy.intp) + self.extent
+        ys = numpy.array([c[1] for c in cells], dtype=numpy.intp) + self.extent
+        edges = self.edges
+        return numpy.array([edges[2, xs, ys + 1],
+                            edges[3, xs + 1, ys],
+                            edges[0, xs, ys - 1],
+                            edges[1, xs - 1, ys]])
+
+    def legal_mask(self, cells, edges, symmetry=4):
+        """
+        Return a (symmetry, len(cells)) boolean array which is true where the
+        tile edges, rotated by the row number of steps, match the neighbours
+        of the cell. The cells must all lie inside the extent.
+        """
+        constraint = self.constraints(cells)
+        rotated = numpy.array([[edges[(i + r) % 4] for i in range(4)]
+                               for r in range(symmetry)], dtype=numpy.int8)
+        constraint = constraint[numpy.newaxis]
+        match = (constraint == NO_TILE) | \
+                (constraint == rotated[:, :, numpy.newaxis])
+        return match.all(axis=1)
+
+    def placements(self, cells, edges, symmetry=4):
+        """
+        Return the list of (x, y, rotation) values where the edges match the
+        neighbouring tiles.
+        """
+        if not cells:
+            return []
+        mask = self.legal_mask(cells, edges, symmetry)
+        rotations, indices = numpy.nonzero(mask)
+        return [(cells[i][0], cells[i][1], int(r))
+                for r, i in zip(rotations, indices)]
@@ -1,4 +1,5 @@
 import collections
+import itertools
 
 NORTH, EAST, SOUTH, WEST = range(4)
 COLOUR_WORLD = 0
@@ -13,6 +14,9 @@ CHAR_CLOISTER = ord('+')
 CHAR_RIVER = ord('~')
 CHAR_FARM = ord("`")
 
+#serial numbers for features, used to key the farm/city adjacency index
+FEATURE_UIDS = itertools.count()
+
 class Feature(object):
     """
     Base class for map features (roads, towns, etc). May be mergeable.
@@ -23,6 +27,18 @@ class Feature(object):
         * tile(s)
 
     Features are mutable, unlike Segments, which are immutable once created.
+    The tiles are kept as a dictionary of tile -> number of segments on it.
+
+    Merged features form a disjoint-set forest: a feature which has been
+    merged into another points to it through parent, and find returns the
+    feature currently representing the whole set.
+
+    Features hash by their segments, which change as they merge, so anything
+    indexing features keys them by their serial uid instead.
+
+    The strength of the avatars each player has on the feature is kept in
+    strengths, as player index -> (player, strength), in the order the players
+    first claimed it; the owners are those with the greatest strength.
     """
     merge = False
     name = None
@@ -30,8 +46,30 @@ class Feature(object):
     def __init__(self, tiles=None):
         self.avatars = []
         self.owners = []
-        self.tiles = tiles if tiles else []
+        self.strengths = {}
+        self.tiles = tiles if tiles else {}
         self.cleared = False
+        self.parent = self
+        self.uid = next(FEATURE_UIDS)
+
+    def find(self):
+        """
+        Return the feature this one has been merged into (or itself), with
+        path compression. Compression is journalled on the world, so that an
+        undo restores the original links.
+        """
+        if self.parent is self:
+            return self
+        root = self.parent
+        while root.parent is not root:
+            root = root.parent
+        node = self
+        while node.parent is not root:
+            parent = node.parent
+            node.segments[0].tile.world.record('parent', node, parent)
+            node.parent = root
+            node = parent
+        return root
 
     def score(self):
         "Calculate the score, usually taking completion into account"
@@ -45,22 +83,36 @@ class Feature(object):
         assert avatar.available
         if self.can_own():
             self.avatars.append(avatar)
+            self.add_strength(avatar.player, avatar.strength)
             self.update_owners()
             return True
         else:
             return False
+
+    def unclaim(self):
+        "Revert the last claim, when undoing it."
+        avatar = self.avatars.pop()
+        self.add_strength(avatar.player, -avatar.strength)
+        self.update_owners()
+
+    def add_strength(self, player, strength):
+        "Add to (or take away from) the strength of a player on the feature."
+        if player.index in self.strengths:
+            strength += self.strengths[player.index][1]
+        if strength:
+            self.strengths[player.index] = (player, strength)
+        else:
+            del self.strengths[player.index]
           
     def update_owners(self):
-        if len(self.avatars) == 0:
+        if len(self.strengths) == 0:
             self.owners = []
-        elif len(self.avatars) == 1:
-            self.owners = [self.avatars[0].player]
+        elif len(self.strengths) == 1:
+            self.owners = [p for p, s in self.strengths.values()]
         else:
-            owner_scores = collections.defaultdict(int)
-            for a in self.avatars:
-                owner_scores[a.player] += a.strength
-            best_score = max(owner_scores.values())
-            self.owners = list(p for p in owner_scores if owner_scores[p] == best_score)
+            best_score = max(s for p, s in self.strengths.values())
+            self.owners = [p for p, s in self.strengths.values()
+                           if s == best_score]
 
     def is_complete(self):
         """
@@ -136,21 +188,33 @@ class Feature(object):
 class Segment(object):
     """
     A single part of a feature on one tile. This is created when the tile is
-    placed and should be immutable after that (except for the feature pointer
-    being updated to point to the feature it currently belongs to).
+    placed and is immutable after that; it keeps a pointer to the feature it
+    was created in, and the feature property resolves that to the feature it
+    currently belongs to.
 
     Since these are immutable, when trying to keep a persistent reference
     to a feature you should keep a reference to a single segment and read
     segment.feature to get the current feature (which will change when extra
-    tiles are added and the existing feature pointer might be invalidated).
+    tiles are added and the existing feature might be merged into another).
     """
     type = 0
     def __init__(self, tile, edges):
         self.tile = tile
         self.edges = tuple(edges)
-        self.feature = None
+        self._feature = None
         self.hash = None
 
+    @property
+    def feature(self):
+        "The feature this segment currently belongs to."
+        if self._feature is None:
+            return None
+        return self._feature.find()
+
+    @feature.setter
+    def feature(self, feature):
+        self._feature = feature
+
     def __hash__(self):
         if self.hash is None:
             self.hash = hash((self.type, self.tile.x, self.tile.y, self.edges))
@@ -168,18 +232,25 @@ class SegmentedFeature(Feature):
     A feature consisting of a number of segments (ie, all of them except
     a cloister). Each component segment has a pointer to the feature to which
     it belongs.
+
+    The number of open edges is kept in open_count, which the world updates
+    as it adds and closes entries in its open edge index, so completion can
+    be tested without collecting the edges.
     """
     merge = True
     VCHAR = HCHAR = LDIAG = RDIAG = ""
     def __init__(self, segments):
         self.segments = segments
-        tiles = list(set(s.tile for s in segments))
+        tiles = {}
+        for s in segments:
+            tiles[s.tile] = tiles.get(s.tile, 0) + 1
         Feature.__init__(self, tiles=tiles)
+        self.open_count = 0
         for s in self.segments:
             s.feature = self
 
     def is_complete(self):
-        return not self.get_edges()
+        return not self.open_count
 
     def __eq__(self, other):
         if isinstance(other, SegmentedFeature):
@@ -243,18 +314,56 @@ class SegmentedFeature(Feature):
 
     def __iadd__(self, other):
         """
-        Join two features, performing the necessary updates. Other is invalid
-        after it has been added.
+        Join two features, performing the necessary updates. The smaller
+        feature (by number of segments) is linked under the larger, which is
+        returned; the other is invalid after it has been added, and its
+        segments resolve to the returned feature.
         """
-        assert not set(self.segments) & set(other.segments), "merging already overlapping features %s %s %s %s" % (self, other, [hash(s) for s in self.segments], [hash(s) for s in other.segments])
-        assert self.get_edges() & other.get_edges(), "edges don't meet %s %s %s %s" % (self, other, self.get_edges(), other.get_edges())
-        self.segments += other.segments
-        for s in self.segments:
-            s.feature = self
-        self.tiles = list(set(s.tile for s in self.segments))
-        self.avatars.extend(other.avatars)
-        self.update_owners()
-        return self
+        assert self.parent is self and other.parent is other and \
+               self is not other, "merging already merged features %s %s" % \
+               (self, other)
+        if len(self.segments) < len(other.segments):
+            root, child = other, self
+        else:
+            root, child = self, other
+        child.parent = root
+        root.segments += child.segments
+        root.open_count += child.open_count
+        for tile, count in child.tiles.items():
+            root.tiles[tile] = root.tiles.get(tile, 0) + count
+            tile.forget_features()
+        root.avatars.extend(child.avatars)
+        if child.strengths:
+            for player, strength in child.strengths.values():
+                root.add_strength(player, strength)
+            root.update_owners()
+        return root
+
+    def merge_state(self, other):
+        """
+        Return the state needed by unmerge to revert a subsequent merge with
+        other in which this feature survives.
+        """
+        return len(self.segments), len(self.avatars), self.owners
+
+    def unmerge(self, other, state):
+        """
+        Revert the merge of other into this feature, given the state returned
+        by merge_state beforehand. Other becomes valid again.
+        """
+        segments, avatars, self.owners = state
+        del self.segments[segments:]
+        self.open_count -= other.open_count
+        for tile, count in other.tiles.items():
+            if self.tiles[tile] == count:
+                del self.tiles[tile]
+            else:
+                self.tiles[tile] -= count
+            tile.forget_features()
+        del self.avatars[avatars:]
+        for player, strength in other.strengths.values():
+            self.add_strength(player, -strength)
+        other.parent = other
 
     def __repr__(self):
         return "<%s %s>" % (self.name, self.segments)
@@ -350,23 +459,69 @@ class City(SegmentedFeature):
     Worth 2 points per tile if complete, 1 point otherwise.
     Pennant tiles are worth double.
     Cities containing a cathedral are worth 3 per tile when completed.
+
+    The farms bordering a city are kept in farms, as uid -> farm; this is the
+    reverse of :attr:`Farm.adjacent_cities` and is re-pointed when cities or
+    farms merge.
+
+    The parts of the score are kept as the city grows: the segments on each
+    (x, y) with and without a pennant, and the number of cathedrals.
     """
     name = "City"
     zindex = 3
-    def score(self):
-        cathedral = False
-        tiles = set()
-        pennant_tiles = set()
-        for seg in self.segments:
-            if seg.pennant:
-                pennant_tiles.add((seg.tile.x, seg.tile.y))
-            else:
-                tiles.add((seg.tile.x, seg.tile.y))
+    def __init__(self, segments):
+        SegmentedFeature.__init__(self, segments)
+        self.farms = {}
+        self.plain_tiles = {}
+        self.pennant_tiles = {}
+        self.cathedrals = 0
+        for seg in segments:
+            xy = (seg.tile.x, seg.tile.y)
+            tiles = self.pennant_tiles if seg.pennant else self.plain_tiles
+            tiles[xy] = tiles.get(xy, 0) + 1
             if seg.cathedral:
-                cathedral = True
-        score = len(tiles) + 2*len(pennant_tiles)
+                self.cathedrals += 1
+
+    def __iadd__(self, other):
+        root = SegmentedFeature.__iadd__(self, other)
+        child = other if root is self else self
+        for uid, farm in child.farms.items():
+            del farm.adjacent_cities[child.uid]
+            farm.adjacent_cities[root.uid] = root
+            root.farms[uid] = farm
+        for xy, count in child.plain_tiles.items():
+            root.plain_tiles[xy] = root.plain_tiles.get(xy, 0) + count
+        for xy, count in child.pennant_tiles.items():
+            root.pennant_tiles[xy] = root.pennant_tiles.get(xy, 0) + count
+        root.cathedrals += child.cathedrals
+        return root
+
+    def merge_state(self, other):
+        #only the farms the merge will add, rather than a copy of them all
+        added = frozenset(uid for uid in other.farms if uid not in self.farms)
+        return SegmentedFeature.merge_state(self, other) + (added, )
+
+    def unmerge(self, other, state):
+        added = state[-1]
+        for uid, farm in other.farms.items():
+            if uid in added:
+                del farm.adjacent_cities[self.uid]
+                del self.farms[uid]
+            farm.adjacent_cities[other.uid] = other
+        for tiles, removed in ((self.plain_tiles, other.plain_tiles),
+                               (self.pennant_tiles, other.pennant_tiles)):
+            for xy, count in removed.items():
+                if tiles[xy] == count:
+                    del tiles[xy]
+                else:
+                    tiles[xy] -= count
+        self.cathedrals -= other.cathedrals
+        SegmentedFeature.unmerge(self, other, state[:-1])
+
+    def score(self):
+        score = len(self.plain_tiles) + 2*len(self.pennant_tiles)
         if self.is_complete():
-            if cathedral:
+            if self.cathedrals:
                 return score*3
             else:
                 return score*2
@@ -456,6 +611,9 @@ class Cloister(Feature, Segment):
     """
     Cloister
     Worth 1 point + 1 per adjacent tile
+
+    The world keeps count of the tiles in the 3x3 block around the cloister
+    (including its own) as they are placed.
     """
     name = "Cloister"
     type = 2
@@ -466,7 +624,8 @@ class Cloister(Feature, Segment):
         self.feature = self
         self.segments = (self, )
         self.hash = None
-        Feature.__init__(self, tiles=[tile])
+        self.neighbours = 1
+        Feature.__init__(self, tiles={tile: 1})
 
     def can_own(self):
         return not self.owners
@@ -475,17 +634,10 @@ class Cloister(Feature, Segment):
         return True
 
     def score(self):
-        x, y = self.tile.x, self.tile.y
-        world = self.tile.world
-        score = 0
-        for i in (-1, 0, 1):
-            for j in (-1, 0, 1):
-                if world[x+i, y+j]:
-                    score += 1
-        return score
+        return self.neighbours
 
     def is_complete(self):
-        return self.score() == 9
+        return self.neighbours == 9
 
     def __repr__(self):
         return "<Cloister x=%d y=%d>" % (self.tile.x, self.tile.y)
@@ -515,6 +667,8 @@ class Road(SegmentedFeature):
     """
     Road
     Worth 1 point per tile.
+
+    The number of inns on the road is kept as it grows.
     """
     VCHAR = CHAR_VROAD
     HCHAR = CHAR_HROAD
@@ -522,17 +676,24 @@ class Road(SegmentedFeature):
     RDIAG = CHAR_RROAD
     zindex = 2
     name = "Road"
+    def __init__(self, segments):
+        SegmentedFeature.__init__(self, segments)
+        self.inns = sum(1 for seg in segments if seg.inn)
+
+    def __iadd__(self, other):
+        root = SegmentedFeature.__iadd__(self, other)
+        root.inns += (other if root is self else self).inns
+        return root
+
+    def unmerge(self, other, state):
+        self.inns -= other.inns
+        SegmentedFeature.unmerge(self, other, state)
+
     def score(self):
-        tiles = set()
-        inn = False
-        for seg in self.segments:
-            tiles.add(seg.tile)
-            if seg.inn:
-                inn = True
-        if inn:
-            return len(tiles) * 2
+        if self.inns:
+            return len(self.tiles) * 2
         else:
-            return len(tiles)
+            return len(self.tiles)
 
     def can_own(self):
         return not self.owners
@@ -567,9 +728,57 @@ class Farm(SegmentedFeature):
     Farm
     Worth 3 per complete city served.
     This is the messy one.
+
+    The cities bordering the farm are kept in adjacent_cities, as uid -> city,
+    along with the number of them which are complete; the world bumps the
+    count as cities are completed, and merges keep both up to date.
+
+    With the lazy-farms option a new farm is not merged with its neighbours
+    until the world's resolve_farms is called, which the methods here do
+    before answering for the farm it has become part of.
     """
     zindex = 0
     name = "Farm"
+    def __init__(self, segments):
+        SegmentedFeature.__init__(self, segments)
+        self.adjacent_cities = {}
+        self.complete_cities = 0
+
+    def add_city(self, city):
+        "Record that the (newly placed) city borders this farm."
+        self.adjacent_cities[city.uid] = city
+        city.farms[self.uid] = self
+
+    def __iadd__(self, other):
+        root = SegmentedFeature.__iadd__(self, other)
+        child = other if root is self else self
+        root.complete_cities += child.complete_cities
+        for uid, city in child.adjacent_cities.items():
+            del city.farms[child.uid]
+            if uid in root.adjacent_cities:
+                if city.is_complete():
+                    root.complete_cities -= 1
+            else:
+                root.adjacent_cities[uid] = city
+                city.farms[root.uid] = root
+        return root
+
+    def merge_state(self, other):
+        #only the cities the merge will add, rather than a copy of them all
+        added = frozenset(uid for uid in other.adjacent_cities
+                          if uid not in self.adjacent_cities)
+        return SegmentedFeature.merge_state(self, other) + \
+               (added, self.complete_cities)
+
+    def unmerge(self, other, state):
+        added, self.complete_cities = state[-2:]
+        for uid, city in other.adjacent_cities.items():
+            if uid in added:
+                del city.farms[self.uid]
+                del self.adjacent_cities[uid]
+            city.farms[other.uid] = other
+        SegmentedFeature.unmerge(self, other, state[:-2])
+
     def is_complete(self):
         return False
 
@@ -584,8 +793,13 @@ class Farm(SegmentedFeature):
     def is_farm(self):
         return True
 
+    def resolve(self):
+        "Merge any pending farms, and return the one this is now part of."
+        self.segments[0].tile.world.resolve_farms()
+        return self.find()
+
     def can_own(self):
-        return not self.owners
+        return not self.resolve().owners
 
     def swap_edge(self, x, y, edge):
         e2 = edge // 2
@@ -603,20 +817,21 @@ class Farm(SegmentedFeature):
         Get a list of cities associated with this farm (optionally selecting
         only complete or incomplete cities).
         """
-        city_segments = set()
-        for seg in self.segments:
-            for cs in seg.city_segments:
-                city_segments.add(cs)
-        cities = set(s.feature for s in city_segments)
+        cities = list(self.resolve().adjacent_cities.values())
         if complete is True:
             return [c for c in cities if c.is_complete()]
         elif complete is False:
             return [c for c in cities if not c.is_complete()]
         else:
-            return list(cities)
+            return cities
+
+    def incomplete_cities(self):
+        "Return the number of incomplete cities bordering the farm."
+        farm = self.resolve()
+        return len(farm.adjacent_cities) - farm.complete_cities
 
     def score(self):
-        return 3*len(self.cities(complete=True))
+        return 3*self.resolve().complete_cities
 
     def draw_tile(self, segments):
         text = [[None]*5 for i in range(9)]
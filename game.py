@@ -1,9 +1,15 @@
-from stack import generate_stack
+from stack import generate_stack, TILE_CODES, CODE_TILES
 from world import World, Player
 from ncurses import NullInterface, CursesInterface
-import copy
 import random
 import collections
+import struct
+
+SNAPSHOT_MAGIC = b'PYCS'
+SNAPSHOT_VERSION = 1
+#turn record: tile code, x, y, claim (segment index | big << 7, or NO_CLAIM)
+SNAPSHOT_TURN = 'HhhB'
+NO_CLAIM = 0xff
 
 class PlayerInterface(object):
     """
@@ -86,8 +92,8 @@ class PlayerInterface(object):
 
     def stack(self):
         """
-        Returns a dictionary of tile -> count showing the types of tiles left
-        in the stack (but not the order).
+        Returns a dictionary of tile type -> count showing the types of tiles
+        left in the stack (but not the order).
         """
         result = collections.defaultdict(int)
         for tile in self.__game.stack:
@@ -111,7 +117,7 @@ class PlayerBase(object):
 
     def place_tile(self, tile, possible):
         """
-        Called with a tile object, and a list of
+        Called with a (shared, immutable) tile type, and a list of
         (x, y, rotate_steps) valid placements.
 
         Return one of the placements as you see fit.
@@ -175,7 +181,11 @@ class Game(object):
         "big-avatars": 0,
         "proxify": True,
         "inns-cathedrals": True,
-        "shuffle-unplaceable": True
+        "shuffle-unplaceable": True,
+        "array-board": False,
+        "dedup-placements": False,
+        "decks": 1,
+        "lazy-farms": False
     }
     option_help = {
         "river": "Enable the river expansion.",
@@ -184,7 +194,11 @@ class Game(object):
         "big-avatars": "Number of big (strength 2) avatars per player.",
         "proxify": "Whether to use copy-on-write or deepcopy to provide AI sandboxes.",
         "inns-cathedrals": "Enable the inns & cathedrals expansion.",
-        "shuffle-unplaceable": "Whether to re-shuffle the stack after a player draws an unplaceable tile."
+        "shuffle-unplaceable": "Whether to re-shuffle the stack after a player draws an unplaceable tile.",
+        "array-board": "Whether to mirror the table in numpy arrays for vectorised placement checks.",
+        "dedup-placements": "Whether AIs evaluate only one of each group of placements with identical effects.",
+        "decks": "Number of copies of the tile set to play through (use a larger extent too).",
+        "lazy-farms": "Whether to merge farms only when something reads them."
     }
     def __init__(self, playerclasses, playeroptions=None, **options):
         self.options = {}
@@ -205,11 +219,15 @@ class Game(object):
                         for i, pc in enumerate(playerclasses)]
 
         self.stack = generate_stack(river=self.options['river'],
-                                    inns_cathedrals=self.options['inns-cathedrals'])
+                                    inns_cathedrals=self.options['inns-cathedrals'],
+                                    decks=self.options['decks'])
         if self.options['inns-cathedrals']:
             self.options['big-avatars'] += 1
         self.world = World(self.options, self.players)
+        self.world.set_stack(self.stack)
         self.turn = 0
+        #(tile type, x, y, claim) for each turn played, see replay
+        self.history = []
 
         self.ai = [self.get_ai(pc)(interface=PlayerInterface(p, self), **po)
                    for p, pc, po in zip(self.players, playerclasses, playeroptions)]
@@ -235,8 +253,7 @@ class Game(object):
                 attempts = 0
                 while True:
                     tile = self.stack.pop(0)
-                    possible_locations = self.world.possible_placements(tile)
-                    if possible_locations:
+                    if self.world.placeable(tile):
                         break
                     else:
                         self.stack.insert(random.randint(1, len(self.stack)), tile)
@@ -244,22 +261,30 @@ class Game(object):
                         assert attempts < 10, "No possible tile placements after 10 reshuffles"
             else:
                 tile = self.stack.pop(0)
-                possible_locations = self.world.possible_placements(tile)
-                assert possible_locations, "No possible tile placements"
-            chosen_placement = ai.place_tile(copy.deepcopy(tile),
-                                             possible_locations)
+            possible_locations = self.world.possible_placements(tile)
+            assert possible_locations, "No possible tile placements"
+            self.world.draw(tile)
+            chosen_placement = ai.place_tile(tile, possible_locations)
             assert chosen_placement in possible_locations, "Chose %s: not in %s" % (chosen_placement, possible_locations)
             x, y, rotate = chosen_placement
             tile = tile.rotate(rotate)
             assert self.world.can_place(tile, x, y)
             features = self.world.place(tile, x, y)
-            features = [f for f in features if f.can_own()]
-            self.interface.add_tile(tile)
+            placed = self.world[x, y]
+            self.interface.add_tile(placed)
             self.interface.centre_map(x, y)
             self.interface.message("")
             for i in self.ai:
-                i.tile_placed(tile, x, y)
-            if player.available() > 0 and features:
+                i.tile_placed(placed, x, y)
+            claim = None
+            if player.available() > 0:
+                #farms have to be merged before they can be claimed
+                if any(f.is_farm() for f in features):
+                    features = self.world.resolve_farms(features)
+                features = [f for f in features if f.can_own()]
+            else:
+                features = []
+            if features:
                 result = ai.place_avatar(features)
                 if isinstance(result, tuple):
                     chosen_feature, big, small = result
@@ -268,7 +293,10 @@ class Game(object):
                     big = small = True
                 if chosen_feature:
                     assert chosen_feature in features, "AI returned invalid feature: %s (valid %s)" % (chosen_feature, features)
-                    player.claim(chosen_feature, big, small)
+                    index = [s.feature for s in placed.segments].index(chosen_feature)
+                    avatar = self.world.claim(player, placed.segments[index],
+                                              big, small)
+                    claim = (index, avatar.big)
                     self.interface.highlight_feature(chosen_feature)
                     self.interface.message("%s claimed %s" % \
                                            (player.name, chosen_feature.name))
@@ -276,15 +304,12 @@ class Game(object):
                     for i in self.ai:
                         i.avatar_placed(chosen_feature, player)
 
-            for feature in self.world.features:
+            self.history.append((tile, x, y, claim))
+
+            #only features on or around the new tile can have been completed
+            for feature in self.world.touched_features(x, y):
                 if feature.is_complete() and not feature.cleared:
-                    score = feature.score()
-                    feature.cleared = True
-                    for owner in feature.owners:
-                        owner.score += score
-                        owner.completed.append(feature)
-                    for avatar in feature.avatars:
-                        avatar.segment = None
+                    score = self.complete_feature(feature)
                     if feature.owners:
                         self.interface.highlight_feature(feature)
                         self.interface.message("%s completed for %d" % \
@@ -294,6 +319,10 @@ class Game(object):
                         i.feature_completed(feature, feature.owners, score)
             self.turn += 1
 
+        #only a claimed farm is scored, so only then merge any pending farms
+        if any(a.segment.feature.is_farm() for player in self.players
+               for a in player.placed):
+            self.world.resolve_farms()
         for player in self.players:
             for avatar in player.avatars:
                 if not avatar.available():
@@ -320,6 +349,140 @@ class Game(object):
             i.game_over()
         return {p.name: p.score for p in self.players}
 
+    def complete_feature(self, feature):
+        """
+        Score a completed feature for its owners and free its avatars,
+        returning the score.
+        """
+        score = feature.score()
+        feature.cleared = True
+        for owner in feature.owners:
+            owner.score += score
+            owner.completed.append(feature)
+        for avatar in feature.avatars:
+            avatar.segment = None
+        return score
+
+    def replay(self, history):
+        """
+        Play a list of (tile type, x, y, claim) turns, as recorded in history,
+        straight into the world without consulting the AIs or the interface.
+        The claim is None or the (segment index, big) of the avatar placed on
+        the new tile.
+        """
+        for tile, x, y, claim in history:
+            player = self.players[self.turn % self.nplayers]
+            self.world.place(tile, x, y)
+            if claim is not None:
+                index, big = claim
+                segment = self.world[x, y].segments[index]
+                if segment.feature.is_farm():
+                    self.world.resolve_farms()
+                self.world.claim(player, segment, big, not big)
+            for feature in self.world.touched_features(x, y):
+                if feature.is_complete() and not feature.cleared:
+                    self.complete_feature(feature)
+            self.history.append((tile, x, y, claim))
+            self.turn += 1
+
+    def save(self):
+        """
+        Encode the game position as a compact byte string: the options, the
+        players, the order of the stack and the turns played, with tiles as
+        the codes in :data:`stack.TILE_CODES`. The AIs and the state of the
+        random module are not saved.
+        """
+        keys = sorted(Game.default_options)
+        result = [struct.pack('<4sBBB', SNAPSHOT_MAGIC, SNAPSHOT_VERSION,
+                              len(keys), self.nplayers)]
+        result.append(struct.pack('<%di' % len(keys),
+                                  *[int(self.options[k]) for k in keys]))
+        for player in self.players:
+            big = sum(1 for a in player.avatars if a.big)
+            result.append(struct.pack('<iBB', player.score,
+                                      len(player.avatars) - big, big))
+            for text in (player.playertype, player.name):
+                text = text.encode('utf-8')
+                result.append(struct.pack('<H', len(text)) + text)
+        result.append(struct.pack('<I%dH' % len(self.stack), len(self.stack),
+                                  *[TILE_CODES[t] for t in self.stack]))
+        turns = []
+        for tile, x, y, claim in self.history:
+            turns += [TILE_CODES[tile], x, y,
+                      NO_CLAIM if claim is None else claim[0] | claim[1] << 7]
+        result.append(struct.pack('<I' + SNAPSHOT_TURN * len(self.history),
+                                  len(self.history), *turns))
+        return b''.join(result)
+
+    @classmethod
+    def load(cls, data, playeroptions=None):
+        """
+        Restore a game encoded by save, with new AIs for the players. The
+        turns are replayed without the AIs, and the world only works out the
+        legal placements for the stack once they are all done.
+        """
+        magic, version, nkeys, nplayers = struct.unpack_from('<4sBBB', data)
+        assert magic == SNAPSHOT_MAGIC, "Not a game snapshot"
+        keys = sorted(Game.default_options)
+        assert version == SNAPSHOT_VERSION and nkeys == len(keys), \
+               "Snapshot from an incompatible version"
+        offset = struct.calcsize('<4sBBB')
+        values = struct.unpack_from('<%di' % nkeys, data, offset)
+        offset += struct.calcsize('<%di' % nkeys)
+
+        game = cls.__new__(cls)
+        game.options = {k: type(Game.default_options[k])(v)
+                        for k, v in zip(keys, values)}
+        game.nplayers = nplayers
+        game.players = []
+        scores = []
+        for i in range(nplayers):
+            score, small, big = struct.unpack_from('<iBB', data, offset)
+            offset += struct.calcsize('<iBB')
+            text = []
+            for j in range(2):
+                length, = struct.unpack_from('<H', data, offset)
+                offset += struct.calcsize('<H')
+                text.append(data[offset:offset + length].decode('utf-8'))
+                offset += length
+            game.players.append(Player(i, text[0], small, big))
+            game.players[-1].name = text[1]
+            scores.append(score)
+
+        count, = struct.unpack_from('<I', data, offset)
+        offset += struct.calcsize('<I')
+        game.stack = [CODE_TILES[c] for c in
+                      struct.unpack_from('<%dH' % count, data, offset)]
+        offset += struct.calcsize('<%dH' % count)
+        count, = struct.unpack_from('<I', data, offset)
+        offset += struct.calcsize('<I')
+        turns = struct.unpack_from('<' + SNAPSHOT_TURN * count, data, offset)
+
+        game.world = World(game.options, game.players)
+        game.turn = 0
+        game.history = []
+        game.replay([(CODE_TILES[turns[i]], turns[i + 1], turns[i + 2],
+                      None if turns[i + 3] == NO_CLAIM else
+                      (turns[i + 3] & 0x7f, bool(turns[i + 3] >> 7)))
+                     for i in range(0, len(turns), 4)])
+        game.world.set_stack(game.stack)
+        for player, score in zip(game.players, scores):
+            player.score = score
+            #a finished game has already scored and lifted every avatar
+            if not game.stack:
+                for avatar in player.avatars:
+                    avatar.segment = None
+
+        if not playeroptions:
+            playeroptions = [{} for _ in range(nplayers)]
+        names = [p.name for p in game.players]
+        game.ai = [game.get_ai(p.playertype)(interface=PlayerInterface(p, game), **po)
+                   for p, po in zip(game.players, playeroptions)]
+        for player, name in zip(game.players, names):
+            player.name = name
+        game.interface = None
+        return game
+
 AI_REGISTRY = {}
 from basic_ai import BasicAI
 from random_ai import RandomAI
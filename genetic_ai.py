@@ -126,7 +126,7 @@ class GeneticAI(PlayerBase):
         elif feature.is_cloister():
             score *= self.genome.cloister_factor
         elif feature.is_farm():
-            score += self.genome.farm_city_factor * len(feature.cities(complete=False))
+            score += self.genome.farm_city_factor * feature.incomplete_cities()
             score *= self.genome.farm_factor
         if len(feature.owners) > 1:
             score *= self.genome.coop_factor
@@ -139,16 +139,19 @@ class GeneticAI(PlayerBase):
         avatars = self.interface.available_avatars()
 
         scores = collections.defaultdict(float)
-        world_features = self.interface.sandbox().features
-        for feature in world_features:
+        sandbox = self.interface.sandbox()
+        if self.interface.option('dedup-placements'):
+            possible = [c[0] for c in sandbox.placement_classes(tile, possible)]
+        for feature in sandbox.features:
             for owner in feature.owners:
                 scores[owner.index] += self.eval_feature(feature)
 
         for (x, y, rotate) in possible:
-            sandbox = self.interface.sandbox()
             placement_feature_score = 0
             placement_feature = None
-            tile_features = sandbox.place(tile.rotate(rotate), x, y)
+            tile_features, token = sandbox.place(tile.rotate(rotate), x, y,
+                                                 undoable=True)
+            tile_features = sandbox.resolve_farms(tile_features)
 
             placement_scores = collections.defaultdict(float)
             for feature in sandbox.features:
@@ -170,7 +173,7 @@ class GeneticAI(PlayerBase):
                             if avatars < turns_left:
                                 score -= (turns_left / max(avatars, 0.5)) * self.genome.avatar_use_factor
                             if feature.is_city():
-                                edges = len(feature.get_edges())
+                                edges = feature.open_count
                                 score -= (edges / max(turns_left, 0.5)) * self.genome.open_edge_factor
 
                         if score > placement_feature_score:
@@ -183,6 +186,7 @@ class GeneticAI(PlayerBase):
             for i in range(self.nplayers):
                 if not i == self.index:
                     their_benefit += placement_scores[i] - scores[i]
+            sandbox.undo(token)
 
             placement_score = our_benefit + placement_feature_score - their_benefit
             if placement_score > best_score:
@@ -1,5 +1,4 @@
 import collections
-import copy
 import time
 from feature import COLOUR_WORLD, COLOUR_CONTESTED
 from world import World
@@ -11,11 +10,17 @@ except ImportError:
     except:
         pass
 
+#tiles along each side of one chunk of a WorldBuffer
+CHUNK = 8
+
 class WorldBuffer(object):
+    """
+    Off-screen drawing of the world, held as curses pads of CHUNK x CHUNK
+    tiles each. A chunk's pad is only allocated when something is first drawn
+    in it, so a large table costs nothing until it is played on.
+    """
     def __init__(self, extent):
-        half_extent = (extent * 2) - 1
-        self.pad = curses.newpad(half_extent * 5 + 1, half_extent * 9 + 1)
-        self.pad.clear()
+        self.chunks = {}
         self.extent = extent
         self.zindex = collections.defaultdict(set)
 
@@ -23,7 +28,7 @@ class WorldBuffer(object):
         """
         Trigger a complete redraw of the world
         """
-        self.pad.clear()
+        self.chunks = {}
         self.zindex = collections.defaultdict(set)
         for tile in world.tiles.values():
             self.update_pad(self._update_tile_all(tile, attrs))
@@ -92,17 +97,58 @@ class WorldBuffer(object):
             self.draw_feature(feature, attrs)
 
     def xytolinecol(self, x, y):
-        line = (self.extent - y - 1) * 5
-        col = (self.extent + x - 1) * 9
-        return line, col
+        """
+        Return the chunk holding tile (x, y), and the line and column of the
+        tile's top left corner in that chunk's pad.
+        """
+        cx, cy = x // CHUNK, y // CHUNK
+        line = (CHUNK - 1 - (y - cy * CHUNK)) * 5
+        col = (x - cx * CHUNK) * 9
+        return (cx, cy), line, col
+
+    def pad(self, chunk):
+        "Get the pad for a chunk, creating it if necessary."
+        if chunk not in self.chunks:
+            #one spare line and column, since curses won't write the last cell
+            self.chunks[chunk] = curses.newpad(CHUNK * 5 + 1, CHUNK * 9 + 1)
+        return self.chunks[chunk]
+
+    def overwrite(self, screen, x, y, line, col, rect=None):
+        """
+        Copy the drawing onto the screen, such that the top left of tile
+        (x, y) lands at (line, col). Only the part inside rect (minline,
+        mincol, maxline, maxcol) is copied, by default the whole screen, and
+        parts with no chunk allocated are left alone.
+        """
+        if rect is None:
+            maxy, maxx = screen.getmaxyx()
+            rect = (0, 0, maxy - 1, maxx - 1)
+        minline, mincol, maxline, maxcol = rect
+        for (cx, cy), pad in self.chunks.items():
+            #screen position of the chunk's top left corner
+            top = line + (y - (cy * CHUNK + CHUNK - 1)) * 5
+            left = col + (cx * CHUNK - x) * 9
+            dminrow = max(minline, top)
+            dmincol = max(mincol, left)
+            dmaxrow = min(maxline, top + CHUNK * 5 - 1)
+            dmaxcol = min(maxcol, left + CHUNK * 9 - 1)
+            if dminrow <= dmaxrow and dmincol <= dmaxcol:
+                pad.overwrite(screen, dminrow - top, dmincol - left,
+                              dminrow, dmincol, dmaxrow, dmaxcol)
 
     def __str__(self):
-        y, x = self.pad.getmaxyx()
+        if not self.chunks:
+            return ""
+        cxs = [c[0] for c in self.chunks]
+        cys = [c[1] for c in self.chunks]
         result = ""
-        for j in range(y):
-            for i in range(x):
-                result += chr(127 & self.pad.inch(j, i))
-            result += "\n"
+        for cy in range(max(cys), min(cys) - 1, -1):
+            for j in range(CHUNK * 5):
+                for cx in range(min(cxs), max(cxs) + 1):
+                    pad = self.chunks.get((cx, cy))
+                    for i in range(CHUNK * 9):
+                        result += chr(127 & pad.inch(j, i)) if pad else " "
+                result += "\n"
         return result
 
     def draw_feature(self, feature, attrs):
@@ -111,12 +157,13 @@ class WorldBuffer(object):
         if feature.cleared:
             attrs |= curses.A_DIM
         for (x, y), text in spec.items():
-            line, col = self.xytolinecol(x, y)
+            chunk, line, col = self.xytolinecol(x, y)
+            pad = self.pad(chunk)
             for tx in range(9):
                 for ty in range(5):
                     char = text[tx][ty]
                     if char:
-                        self.pad.addch(line+ty, col+tx, char, colour | attrs)
+                        pad.addch(line+ty, col+tx, char, colour | attrs)
 
 
 class NullInterface(object):
@@ -202,22 +249,9 @@ class CursesInterface(object):
         self.win_centre.overlay(self.screen)
 
     def centre_map(self, x, y, update=False):
-        line, col = self.world_buffer.xytolinecol(x, y)
-        sminrow = line - self.originy
-        smincol = col - self.originx
-        pminrow = 0
-        pmincol = 0
-        if sminrow < 0:
-            pminrow = abs(sminrow)
-            sminrow = 0
-        if smincol < 0:
-            pmincol = abs(smincol)
-            smincol = 0
-        maxline, maxcol = self.world_buffer.pad.getmaxyx()
-        pmaxrow = min(self.maxy - 1, maxline - line)
-        pmaxcol = min(self.maxx - 1, maxcol - col)
-        self.world_buffer.pad.overwrite(self.screen, sminrow, smincol,
-                                        pminrow, pmincol, pmaxrow, pmaxcol)
+        self.screen.erase()
+        self.world_buffer.overwrite(self.screen, x, y,
+                                    self.originy, self.originx)
         if update:
             self.screen.refresh()
 
@@ -244,6 +278,7 @@ class CursesInterface(object):
                 return possible[index % len(possible)]
             elif key == ord("l"):
                 message = []
+                self.game.world.resolve_farms()
                 for feature in player.features():
                     message += [feature.desc(owner=False)]
                 if not message:
@@ -294,16 +329,15 @@ class CursesInterface(object):
     def _place_tile(self, tile, xyr, msg):
         x, y, rotate = xyr
         self.centre_map(x, y)
-        cloned_tile = copy.deepcopy(tile)
-        cloned_tile = cloned_tile.rotate(rotate)
         place_world = World(self.game.options, [])
-        place_world.place(cloned_tile, 0, 0)
+        place_world.place(tile.rotate(rotate), 0, 0)
         self.place_buffer.update_world(place_world,
                                        curses.A_BOLD |
                                        curses.color_pair(COLOUR_CONTESTED))
-        self.place_buffer.pad.overwrite(self.screen, 0, 0,
-                                        self.originy, self.originx,
-                                        self.originy + 4, self.originx + 8)
+        self.place_buffer.overwrite(self.screen, 0, 0,
+                                    self.originy, self.originx,
+                                    (self.originy, self.originx,
+                                     self.originy + 4, self.originx + 8))
 
         self.update_left()
         self.update_right("Tile Placement Mode")
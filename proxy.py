@@ -18,10 +18,27 @@ TupleType = type((1, 2))
 ListType = type([1, 2])
 DictType = type({1: 2})
 SetType = type({1, 2})
+FrozenSetType = frozenset
 ObjectType = object
 
+try:
+    from numpy import ndarray
+    #arrays are copied outright when a proxy first touches them
+    COPY_TYPES = (ndarray,)
+except ImportError:
+    COPY_TYPES = ()
+
 PROXY_CLASSES = {}
 
+def register_immutable(cls):
+    """
+    Class decorator marking a class whose instances are shared between the
+    world and its proxies rather than being proxied themselves.
+    """
+    global IGNORE
+    IGNORE = IGNORE + (cls,)
+    return cls
+
 def get_proxy_class(cls):
     proxy_cls = PROXY_CLASSES.get(cls.__name__, None)
     if proxy_cls:
@@ -52,7 +69,7 @@ def proxify(obj, memo=None):
     obj_bases = obj_type.__bases__ if hasattr(obj_type, '__bases__') else ()
 
     if obj_type in (IntType, BooleanType, FloatType, LongType,
-                    NoneType, StringType, UnicodeType):
+                    NoneType, StringType, UnicodeType, FrozenSetType):
         return obj
 
     for pt in PROXY_TYPES:
@@ -76,6 +93,8 @@ def proxify(obj, memo=None):
         value = ProxyDict(obj, memo)
     elif obj_type == SetType:
         value = ProxySet(obj, memo)
+    elif obj_type in COPY_TYPES:
+        value = obj.copy()
     elif isinstance(obj, ObjectType):
         if obj_type in IGNORE:
             value = obj
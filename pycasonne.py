@@ -37,13 +37,15 @@ parser.add_argument("--silent", default=False, action="store_true",
                     help="Disable ncurses output.")
 parser.add_argument("--seed", default=None, type=int,
                     help="Random number generator seed.")
+#keep the option names as the destinations, since argparse would otherwise
+#store eg --lazy-farms as lazy_farms, which Game does not know
 for k, v in Game.default_options.items():
     if type(v) == bool:
-        parser.add_argument("--"+k, type=arg_bool, default=v,
+        parser.add_argument("--"+k, type=arg_bool, default=v, dest=k,
                             help=Game.option_help[k]+' (default: %(default)s)',
                             metavar="y/n")
     else:
-        parser.add_argument("--"+k, type=type(v), default=v,
+        parser.add_argument("--"+k, type=type(v), default=v, dest=k,
                             help=Game.option_help[k]+' (default: %(default)s)',
                             metavar=type(v).__name__)
 parser.add_argument("players", metavar="PLAYERS", action=AIAction, nargs="+",
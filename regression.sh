@@ -0,0 +1,15 @@
+#!/bin/bash
+
+#games which have broken before; each must run to the end
+seeds=( 2 4 5 6 7 8 10 )
+status=0
+for interp in python python3 $@; do
+    for seed in ${seeds[@]}; do
+        $interp pycasonne.py --silent --proxify no --seed $seed GeneticAI BasicAI GeneticAI BasicAI &> /dev/null
+        if [ "$?" -gt 0 ]; then
+            echo "interp=$($interp -V 2>&1 | tail -n 1), proxify=no, seed=$seed, status=failed"
+            status=1
+        fi
+    done
+done
+exit $status
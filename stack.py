@@ -1,4 +1,5 @@
-from world import Tile, ROAD, RIVER, CLOISTER, PENNANT, CITY, CATHEDRAL, INN
+from world import (TileType, ROAD, RIVER, CLOISTER, PENNANT, CITY, CATHEDRAL,
+                   INN, register_compatibility)
 import random
 
 """
@@ -10,7 +11,7 @@ where CENTRE can be a binary OR of multiple attributes and the optional hint
 argument is a dictionary overrides for the segments that should appear.
 
 Note that arbitrary new combinations here may work, but might either not have
-the correct segments produced by :func:`world.Tile.build_features` or the correct
+the correct segments produced by :func:`world.TileType.build_features` or the correct
 representation produced by :func:`feature.Feature.draw`.
 """
 
@@ -157,31 +158,56 @@ def inns_cathedrals_set():
                {'farm':((0, 3, 4, 7), (1, 2), (5, 6)), 'road': ((0, 1), (2, 3))})]
     return tiles
 
-def generate_stack(river=True, inns_cathedrals=True):
+def catalogue():
+    "Every tile definition known to this module, including the start tiles"
+    return standard_set() + river_set() + river_ii_set() + abbey_mayor_set() +\
+           mini_expansion_set() + inns_cathedrals_set() +\
+           [(None, RIVER, None, None, None), (None, ROAD, CITY, ROAD, None)]
+
+#build the edge compatibility table used for placement checks once, up front,
+#and number every rotation of every tile type for compact game snapshots; the
+#code is (catalogue index << 2 | rotation), so is stable while the catalogue
+#order is
+TILE_CODES = {}
+CODE_TILES = {}
+for i, t in enumerate(catalogue()):
+    base = TileType(*t)
+    register_compatibility(base.edges)
+    for r in range(4):
+        if base.rotate(r) not in TILE_CODES:
+            TILE_CODES[base.rotate(r)] = (i << 2) | r
+            CODE_TILES[(i << 2) | r] = base.rotate(r)
+
+def generate_stack(river=True, inns_cathedrals=True, decks=1):
     """
-    Generate a list of :class:`world.Tile` instances, randomly shuffled and
-    containing the selected expansions.
+    Generate a list of :class:`world.TileType` handles, randomly shuffled and
+    containing the selected expansions. With decks > 1 that many copies of the
+    base set (and inns & cathedrals) are shuffled together, for long games;
+    the river is only ever played once.
     """
-    rest = [Tile(*t) for t in standard_set()]
-    if inns_cathedrals:
-        rest += [Tile(*t) for t in inns_cathedrals_set()]
+    rest = []
+    for i in range(decks):
+        rest += [TileType(*t) for t in standard_set()]
+        if inns_cathedrals:
+            rest += [TileType(*t) for t in inns_cathedrals_set()]
     random.shuffle(rest)
     if river:
-        start = Tile(None, RIVER, None, None, None)
-        end = Tile(None, RIVER, None, None, None)
-        river = [Tile(*t) for t in river_set()]
+        start = TileType(None, RIVER, None, None, None)
+        end = TileType(None, RIVER, None, None, None)
+        river = [TileType(*t) for t in river_set()]
         random.shuffle(river)
         return [start] + river + [end] + rest
     else:
-        start = Tile(None, ROAD, CITY, ROAD, None)
+        start = TileType(None, ROAD, CITY, ROAD, None)
         return [start] + rest
 
 if __name__ == '__main__':
     from world import World
 
     for t in inns_cathedrals_set():
-        tile = Tile(*t)
-        tile.place(0, 0, World({}, []))
+        world = World({}, [])
+        world.place(TileType(*t), 0, 0)
+        tile = world[0, 0]
         print(tile)
         print(tile.image())
         print("Features:")
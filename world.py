@@ -2,8 +2,10 @@ from feature import (City, CitySegment, Road, RoadSegment, Cloister, River,
                      RiverSegment, Farm, FarmSegment, Feature, Segment)
 
 import copy
+import zlib
 #import cPickle as pickle
-from proxy import proxify
+from proxy import proxify, register_immutable
+from board import ArrayBoard
 
 NORTH, EAST, SOUTH, WEST = range(4)
 EMPTY = 0
@@ -16,48 +18,260 @@ OR_STR = lambda x: ' '.join(v for k, v in EDGES.items()
                             if k is not None and k & x)
 
 SYMMETRY_CACHE = {}
-FEATURE_CACHE = {}
+TILE_TYPES = {}
+COMPATIBILITY = {}
+CANONICAL_EDGES = {}
+FITS_CACHE = {}
+SEGMENT_LAYOUTS = {}
+MASK64 = (1 << 64) - 1
+
+def splitmix64(x):
+    "One step of the splitmix64 generator, as a 64-bit mixing function."
+    z = (x + 0x9E3779B97F4A7C15) & MASK64
+    z = ((z ^ (z >> 30)) * 0xBF58476D1CE4E5B9) & MASK64
+    z = ((z ^ (z >> 27)) * 0x94D049BB133111EB) & MASK64
+    return z ^ (z >> 31)
+
+def zobrist_key(*values):
+    """
+    Return a 64-bit key for a tuple of integers. Keys are derived from the
+    values alone (not the random module), so hashes are the same in every
+    process and do not disturb seeded games.
+    """
+    h = 0
+    for v in values:
+        h = splitmix64(h ^ (v & MASK64))
+    return h
+
+def rotate_edges(edges, steps):
+    "Return the edge tuple as it would be after TileType.rotate(steps)."
+    return tuple(edges[(i + steps) % 4] for i in range(4))
 
-class Tile(object):
+def edge_symmetry(edges):
     """
-    Class representing a game tile.
+    Return the number of distinct rotations (1, 2 or 4) of an edge tuple.
+    """
+    if edges not in SYMMETRY_CACHE:
+        if edges == rotate_edges(edges, 1):
+            SYMMETRY_CACHE[edges] = 1
+        elif edges == rotate_edges(edges, 2):
+            SYMMETRY_CACHE[edges] = 2
+        else:
+            SYMMETRY_CACHE[edges] = 4
+    return SYMMETRY_CACHE[edges]
 
-    This both represents a free, rotateable tile (x, y, world -> None) and
-    a tile anchored in the world. TODO: Split this into two classes.
+def register_compatibility(edges):
+    """
+    Add an edge tuple to the compatibility table. This is done for the whole
+    tile catalogue when :mod:`stack` is imported, and not during a game.
+
+    COMPATIBILITY maps a cell constraint (N, E, S, W), where each value is the
+    edge the neighbouring tile presents or None if there is no neighbour, to
+    the set of (edges, rotation) pairs which fit that cell. Only one edge
+    tuple of each set of rotations is entered, as the base of the others in
+    CANONICAL_EDGES; each distinct rotation of it is entered under all 16
+    wildcard patterns of its own edges.
+    """
+    if edges in CANONICAL_EDGES:
+        return
+    #the cached fits of every cell would be out of date, and so would the
+    #fits, dead cells and legal placements the worlds have kept from them
+    assert not FITS_CACHE, \
+           "Edge tuple %s registered after placement checks began" % (edges,)
+    for r in range(4):
+        CANONICAL_EDGES.setdefault(rotate_edges(edges, r), (edges, r))
+    for r in range(edge_symmetry(edges)):
+        rotated = rotate_edges(edges, r)
+        for mask in range(16):
+            constraint = tuple(rotated[i] if mask & (1 << i) else None
+                               for i in range(4))
+            COMPATIBILITY.setdefault(constraint, set()).add((edges, r))
+
+def canonical_edges(edges):
+    """
+    Return (base, offset) for a registered edge tuple, where base is the edge
+    tuple its rotations are entered in the compatibility table under, and the
+    edges are those of base rotated by offset steps.
+    """
+    return CANONICAL_EDGES[edges]
 
-    Rotating the tile returns a new tile instance.
+def compatible(edges, rotation, constraint):
+    "Test whether the edges rotated by rotation steps satisfy a constraint."
+    base, offset = CANONICAL_EDGES[edges]
+    rotation = (offset + rotation) % edge_symmetry(base)
+    return (base, rotation) in COMPATIBILITY.get(constraint, ())
 
-    The tile is defined by (CENTRE, EDGES[4] [, hint]). The symmetry of the tile
-    is checked and cached for determining available moves.
+def constraint_fits(constraint):
+    """
+    Return (fits, river) for a cell constraint, where fits is the
+    :class:`CellFits` of the base edge tuples without a river which
+    satisfy it, and river the (edges, rotation) pairs with a river which do,
+    and so are also subject to the river rules. A river tile must continue a
+    neighbouring river, so river is empty unless the constraint has one.
+    """
+    if constraint not in FITS_CACHE:
+        moves = []
+        river = []
+        for e, r in sorted(COMPATIBILITY.get(constraint, ())):
+            if RIVER not in e:
+                moves.append((e, r))
+            elif RIVER in constraint:
+                river.append((e, r))
+        FITS_CACHE[constraint] = CellFits(moves), tuple(river)
+    return FITS_CACHE[constraint]
+
+def segment_layout(tiletype):
+    """
+    Return the segments a tile of the given type is made of, in the order of
+    its builders, as built on a detached tile which is never placed. Farm
+    segments keep their city segments as indices into the city segments.
+    """
+    if tiletype not in SEGMENT_LAYOUTS:
+        tile = PlacedTile(tiletype, 0, 0, None)
+        SEGMENT_LAYOUTS[tiletype] = tuple(builder(tile).segments[0]
+                                          for builder in tiletype.builders)
+    return SEGMENT_LAYOUTS[tiletype]
+
+def rotate_hint(hint, steps):
+    "Return a segment hint dictionary rotated by the given number of steps."
+    result = {}
+    for key in hint:
+        if key == 'farm':
+            result['farm'] = tuple(tuple(h if h == 8 else (h - (steps * 2)) % 8
+                                         for h in fhint)
+                                   for fhint in hint['farm'])
+        else:
+            result[key] = tuple(tuple((h - steps) % 4 if isinstance(h, int) else h
+                                      for h in hh)
+                                for hh in hint[key])
+    return result
 
-    The features on the tile are calculated once by build_features (producing a
-    list of functions with signature f(tile) -> feature) and cached, since AI
-    placement testing would otherwise involve repeatedly calculating this.
+@register_immutable
+class CellFits(object):
     """
-    def __init__(self, centre, north, east, south, west, hint=None):
-        self.edges = tuple(EMPTY if i==None else i
-                           for i in (north, east, south, west))
-        self.centre = centre if centre is not None else EMPTY
-        self.segments = []
-        self.hint = hint if hint else {}
-        self.x = None
-        self.y = None
-        self.world = None
+    The tiles which could be placed in an empty cell: moves is the tuple of
+    (edges, rotation) pairs which fit, and edges the frozenset of their edge
+    tuples. These are immutable and shared between all the cells with the
+    same constraint, and between a world and its sandboxes.
+    """
+    __slots__ = ('moves', 'edges')
+    def __init__(self, moves):
+        self.moves = tuple(moves)
+        self.edges = frozenset(e for e, r in self.moves)
 
-        if self.edges in SYMMETRY_CACHE:
-            self.symmetry = SYMMETRY_CACHE[self.edges]
-        else:
-            rotate = lambda e, i: tuple(e[(x+i)%4] for x in range(4))
-            if self.edges == rotate(self.edges, 1) ==\
-                             rotate(self.edges, 2) == rotate(self.edges, 3):
-                self.symmetry = 1
-            elif self.edges == rotate(self.edges, 2):
-                self.symmetry = 2
-            else:
-                self.symmetry = 4
-            SYMMETRY_CACHE[self.edges] = self.symmetry
+    def __deepcopy__(self, memo):
+        return self
+
+    def __copy__(self):
+        return self
+
+    def __repr__(self):
+        return "<CellFits %s>" % (self.moves,)
+
+NO_FITS = CellFits(())
+
+class FeatureList(object):
+    """
+    Features in the order they were added, kept in the slots of a list with a
+    uid -> slot index, so that adding, removing and membership tests are all
+    O(1). Removing a feature empties its slot rather than shifting the rest,
+    so that undo can put it back in the same place; compact drops the empty
+    slots, and must not be used while an undo could still refer to them.
+    """
+    def __init__(self):
+        self.slots = []
+        self.index = {}
+
+    def __len__(self):
+        return len(self.index)
+
+    def __contains__(self, feature):
+        return feature.uid in self.index
+
+    def __iter__(self):
+        for feature in self.slots:
+            if feature is not None:
+                yield feature
+
+    def add(self, feature):
+        self.index[feature.uid] = len(self.slots)
+        self.slots.append(feature)
+
+    def pop(self):
+        "Remove the feature added last, which must still be present."
+        del self.index[self.slots.pop().uid]
+
+    def remove(self, feature):
+        "Remove the feature, returning its slot for restore."
+        slot = self.index.pop(feature.uid)
+        self.slots[slot] = None
+        return slot
+
+    def restore(self, feature, slot):
+        self.slots[slot] = feature
+        self.index[feature.uid] = slot
+
+    def replace(self, feature, other):
+        "Put other in the slot of feature, which must be present."
+        self.restore(other, self.index.pop(feature.uid))
+
+    def compact(self):
+        self.slots = [f for f in self.slots if f is not None]
+        self.index = dict((f.uid, i) for i, f in enumerate(self.slots))
+
+@register_immutable
+class TileType(object):
+    """
+    Class representing a free, rotateable tile.
+
+    Tile types are immutable and interned: constructing a type with the same
+    (CENTRE, EDGES[4] [, hint]) returns the same shared instance, so the stack,
+    the AIs and the interface can pass these handles around freely. Copying a
+    type returns the type itself.
+
+    All four rotations of a type are computed once when it is first created,
+    so rotating is a lookup. The symmetry of the edges is cached for determining
+    available moves.
+
+    The features on the tile are calculated once by build_features (producing a
+    list of functions with signature f(tile) -> feature) and kept on each
+    rotation, since AI placement testing would otherwise involve repeatedly
+    calculating this.
+    """
+    def __new__(cls, centre, north, east, south, west, hint=None):
+        edges = tuple(EMPTY if i==None else i
+                      for i in (north, east, south, west))
+        centre = centre if centre is not None else EMPTY
+        hint = rotate_hint(hint, 0) if hint else {}
+        base = cls._intern(centre, edges, hint)
+        if base.rotations is None:
+            types = [base] + [cls._intern(centre, rotate_edges(edges, r),
+                                          rotate_hint(hint, r))
+                              for r in range(1, 4)]
+            for i, t in enumerate(types):
+                t.rotations = tuple(types[(i + r) % 4] for r in range(4))
+        return base
+
+    @classmethod
+    def _intern(cls, centre, edges, hint):
+        key = (centre, edges, tuple(sorted(hint.items())))
+        if key not in TILE_TYPES:
+            self = object.__new__(cls)
+            self.centre = centre
+            self.edges = edges
+            self.hint = hint
+            self.symmetry = edge_symmetry(edges)
+            self.rotations = None
+            self.builders = self.build_features()
+            self.zobrist = zlib.crc32(repr(key).encode('ascii')) & 0xffffffff
+            TILE_TYPES[key] = self
+        return TILE_TYPES[key]
 
     def build_features(self):
+        """
+        Work out the segments on this tile, returning a list of functions with
+        signature f(tile) -> feature which create them on a placed tile.
+        """
         builders = []
 
         road_edges = [i for i in range(4) if self.edges[i] == ROAD]
@@ -179,18 +393,70 @@ class Tile(object):
 
         return builders
 
-    def place(self, x, y, world):
+    def rotate(self, steps):
+        "Return the (shared) type of this tile rotated clockwise by steps."
+        return self.rotations[steps % 4]
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __copy__(self):
+        return self
+
+    def __reduce__(self):
+        return (TileType, (self.centre,) + self.edges + (self.hint,))
+
+    def __repr__(self):
+        return "<TileType edges=%s centre=%s>" % \
+               ([EDGES[i] for i in self.edges], OR_STR(self.centre))
+
+class PlacedTile(object):
+    """
+    Class representing a tile anchored in the world.
+
+    A placed tile is created by World.place and holds only its coordinates, a
+    reference to its shared :class:`TileType` and its segments; the edges and
+    centre are read from the type. Slots keep the per-tile cost down, which
+    matters for deepcopied sandboxes.
+
+    The features on the tile are cached in views, by name (and None for all of
+    them), until one of them merges or unmerges and calls forget_features.
+    """
+    __slots__ = ('x', 'y', 'type', 'segments', 'world', 'views')
+    def __init__(self, tiletype, x, y, world):
+        self.type = tiletype
         self.x = x
         self.y = y
         self.world = world
+        self.segments = []
+        self.views = None
+
+    def __deepcopy__(self, memo):
+        #a tile only exists as part of its world, which copies every tile
+        copy.deepcopy(self.world, memo)
+        return memo[id(self)]
+
+    @property
+    def edges(self):
+        return self.type.edges
+
+    @property
+    def centre(self):
+        return self.type.centre
 
-        key = (self.edges, self.centre)
-        if key not in FEATURE_CACHE:
-            FEATURE_CACHE[key] = self.build_features()
+    def place(self):
+        """
+        Create the features on this tile, merging them with those on the
+        neighbouring tiles. Returns the list of resulting features.
 
+        With the lazy-farms option the farms are left unmerged, and are only
+        merged when the world's resolve_farms is called. They still take their
+        places in the world's list now, so that the list comes out in the same
+        order either way.
+        """
         features = []
 
-        for builder in FEATURE_CACHE[key]:
+        for builder in self.type.builders:
             features.append(builder(self))
 
         city_segments = []
@@ -201,68 +467,84 @@ class Tile(object):
             if feature.is_farm():
                 feature.segments[0].city_segments = tuple(city_segments[i]
                                                           for i in feature.segments[0].city_segments)
+                for seg in feature.segments[0].city_segments:
+                    feature.add_city(seg.feature)
 
+        farms = []
         for feature in features:
-            if feature.merge:
-                to_merge = set()
-                for x, y, edge in feature.get_edges():
-                    if x == self.x and y == self.y:
-                        nx, ny, _ = feature.swap_edge(x, y, edge)
-                    else:
-                        nx, ny = x, y
-                    other_tile = self.world[nx, ny]
-                    if other_tile:
-                        other_features = other_tile.features(feature.name)
-                        for other_feature in other_features:
-                            if feature.get_edges() & other_feature.get_edges():
-                                to_merge.add(other_feature)
-
-                for merge in to_merge:
-                    feature += merge
-                    if merge in self.world.features:
-                        self.world.features.remove(merge)
-
-
-        for feature in features[:]:
-            if not feature.segments[0].feature == feature:
-                features.remove(feature)
-
-        self.world.features.extend(features)
+            if feature.is_farm() and self.world.lazy_farms:
+                farms.append(feature)
+            elif feature.merge:
+                feature = self.merge_feature(feature)
+                #cities all come before the farms, so the farms bordering a
+                #city are counted before any of them merge
+                if feature.is_city() and feature.is_complete():
+                    self.world.complete_city(feature)
+        if farms:
+            self.world.defer_farms(farms)
+
+        #a feature survives in the place of the last one on this tile which
+        #was merged into it
+        roots = [feature.find() for feature in features]
+        features = [root for i, root in enumerate(roots)
+                    if not any(root is r for r in roots[i + 1:])]
+
+        self.world.add_features(features)
         return features
 
-    def rotate(self, steps):
-        assert self.x==None and self.y==None
-        if self.hint:
-            hint = {}
-            for key in self.hint:
-                if key == 'farm':
-                    hint['farm'] = [[h if h == 8 else (h - (steps * 2)) % 8
-                                     for h in fhint]
-                                    for fhint in self.hint['farm']]
+    def merge_feature(self, feature):
+        """
+        Match up the edges of a new feature on this tile with the open edges
+        of the world, merging it with the features they belong to. Returns
+        the feature it ends up part of.
+        """
+        to_merge = []
+        for seg in feature.segments:
+            for edge in seg.edges:
+                if edge == 8:
+                    continue
+                key = (feature.name,) + \
+                      feature.normalise_edge(self.x, self.y, edge)
+                other = self.world.open_edges.get(key)
+                if other is None:
+                    self.world.set_open_edge(key, seg)
                 else:
-                    hint[key] = [[(h - steps) % 4 if isinstance(h, int) else h
-                                  for h in hh]
-                                 for hh in self.hint[key]]
-        else:
-            hint = None
-        return Tile(self.centre,
-                    *[self.edges[(i + steps) % 4] for i in range(4)],
-                    hint=hint)
-
-    def reset(self):
-        self.segments = []
-        self.x = None
-        self.y = None
-        self.world = None
+                    self.world.set_open_edge(key, None)
+                    other = other.feature
+                    if not any(other is m for m in to_merge):
+                        to_merge.append(other)
+
+        for merge in to_merge:
+            #the state is only needed, and only worth copying, for an undo
+            if self.world.journalling:
+                self.world.record('merge', feature, merge,
+                                  feature.merge_state(merge),
+                                  merge.merge_state(feature))
+            if merge in self.world.features:
+                self.world.remove_feature(merge)
+            feature += merge
+        return feature
 
     def features(self, feature_name=None):
-        result = list(set(s.feature for s in self.segments if s.feature))
-        if feature_name:
-            result = [f for f in result if f.name == feature_name]
-        return result
+        """
+        Return the features with segments on this tile (optionally only those
+        with the given name). The list is shared, and must not be modified.
+        """
+        self.world.resolve_farms()
+        if self.views is None:
+            views = {None: list(set(s.feature for s in self.segments
+                                    if s.feature))}
+            for feature in views[None]:
+                views.setdefault(feature.name, []).append(feature)
+            self.views = views
+        return self.views.get(feature_name or None, [])
+
+    def forget_features(self):
+        "Drop the cached features, after a feature on the tile has merged."
+        self.views = None
 
     def __eq__(self, other):
-        if isinstance(other, Tile):
+        if isinstance(other, PlacedTile):
             return self.x == other.x and self.y == other.y and\
                    self.edges == other.edges and self.centre == other.centre
         return NotImplemented
@@ -278,7 +560,7 @@ class Tile(object):
         return hash((self.x, self.y, tuple(self.edges), self.centre))
 
     def __repr__(self):
-        return "<Tile x=%s y=%s edges=%s centre=%s>" % \
+        return "<PlacedTile x=%s y=%s edges=%s centre=%s>" % \
                (self.x, self.y, [EDGES[i] for i in self.edges],
                 OR_STR(self.centre))
 
@@ -303,7 +585,9 @@ class World(object):
     Top-level class for in in-play game world.
 
     This class maintains a list of players, tiles and a global list of features
-    (to avoid unnecessary object traversal to make this list on demand).
+    (to avoid unnecessary object traversal to make this list on demand). It also
+    keeps the frontier, the set of empty cells adjacent to at least one placed
+    tile, which are the only cells where a new tile could possibly go.
 
     Tile placement rules are enforced by this class - edges must match, tiles
     must be placed within a maximum extent (ie, the "table" size), and other
@@ -312,14 +596,65 @@ class World(object):
     The clone method provides a sandbox world for AI players to experiment with.
     Depending on the proxify option, this is either a completely deepcopied
     version of the world or a copy-on-write proxy.
+
+    For every frontier cell the world also keeps the edge tuples of the tile
+    types which could be placed there, by the base tuple of their rotations
+    (see canonical_edges). Given the tiles left in the stack (see
+    set_stack and draw), cells which none of them fit are kept in the dead
+    set; features with an open edge on a dead cell can never be completed. The
+    legal placements of each type in the stack are kept up to date in the same
+    way, so possible_placements is a lookup for any of them. With the
+    array-board option, placement checks are answered by the board instead.
+
+    The zobrist attribute is a 64-bit hash of the position, the XOR of a key
+    for each tile (type, rotation and coordinates) and for each avatar claim
+    made. Completion follows from these, so equal positions reached in any
+    order hash the same.
+
+    An undoable placement records every change it makes in a journal, so that
+    undo can revert it exactly and a single sandbox can be used to try out any
+    number of placements. While the journal is non-empty all placements are
+    recorded, so undoing a token also reverts any later placements.
     """
     def __init__(self, options, players):
         self.tiles = {}
         self.options = options
         self.extent = options.get('extent', 20)
         self.proxify = options.get('proxify', True)
+        self.lazy_farms = options.get('lazy-farms', False)
         self.players = players
-        self.features = []
+        self.features = FeatureList()
+        self.frontier = set()
+        #empty cell (x, y, edge) the river flows into next, and a bitmask of
+        #the directions it has flowed so far
+        self.river_head = None
+        self.river_edges = 0
+        #(name, x, y, edge) -> segment for every open feature edge, with the
+        #edges normalised as by SegmentedFeature.normalise_edge
+        self.open_edges = {}
+        #(x, y) -> cloister for every placed cloister
+        self.cloisters = {}
+        #frontier (x, y) -> CellFits of the tiles which could go there, and
+        #the cells none of the remaining tiles in the stack fit
+        self.fits = {}
+        self.dead = set()
+        #base edge tuple -> count of the tiles left in the stack, if known
+        self.remaining = None
+        self.remaining_edges = None
+        #base edge tuple -> set of legal (x, y, rotation of the base), for the
+        #tiles in the stack
+        self.legal = {}
+        #lists of the new farms on each tile placed since they were last
+        #merged, with the lazy-farms option
+        self.pending_farms = []
+        #optional dense mirror of the tile edges for vectorised legality checks
+        if options.get('array-board', False):
+            self.board = ArrayBoard(self.extent)
+        else:
+            self.board = None
+        self.zobrist = 0
+        self.journal = []
+        self.journalling = False
 
     def __getitem__(self, xy):
         if xy in self.tiles:
@@ -337,49 +672,464 @@ class World(object):
         else:
             return x-1, y, 1
 
+    def constraint(self, x, y):
+        """
+        Return the (N, E, S, W) edges a tile at (x, y) must match, with None
+        for sides which have no neighbouring tile.
+        """
+        result = []
+        for i in range(4):
+            ox, oy, oedge = self.adjacent_edge(x, y, i)
+            other = self[ox, oy]
+            result.append(other.edges[oedge] if other else None)
+        return tuple(result)
+
     def can_place(self, tile, x, y):
         if abs(x) >= self.extent or abs(y) >= self.extent:
             return False
-        for i in range(4):
-            ox, oy, oedge = self.adjacent_edge(x, y, i)
-            if self[ox, oy] and tile.edges[i] != self[ox, oy].edges[oedge]:
+        if self.board is not None:
+            if not self.board.legal_mask([(x, y)], tile.edges, 1)[0, 0]:
                 return False
+        elif not compatible(tile.edges, 0, self.constraint(x, y)):
+            return False
+        return self.river_allowed(tile.edges, x, y)
 
-        if self.tiles and RIVER in tile.edges:
+    def river_allowed(self, edges, x, y):
+        """
+        Check the special river rules for a tile with the given (already
+        rotated) edges at (x, y). Edge matching is assumed to have been done.
+        """
+        if self.tiles and RIVER in edges:
             #placement only valid if continuing river and not turning 180deg
             river_matched = False
             for i in range(4):
-                if tile.edges[i] == RIVER:
+                if edges[i] == RIVER:
                     ox, oy, oedge = self.adjacent_edge(x, y, i)
-                    if self[ox, oy] and tile.edges[i] == self[ox, oy].edges[oedge]:
+                    if self[ox, oy] and edges[i] == self[ox, oy].edges[oedge]:
                         river_matched = True
                         break
             if not river_matched:
                 return False
 
-            river_tile = self[0, 0]
-            river_edges = [i for i in range(4) if river_tile.edges[i] == RIVER]
-
-            while True:
-                nx, ny, nedge = self.adjacent_edge(river_tile.x, river_tile.y,
-                                                   river_edges[-1])
-                if self[nx, ny]:
-                    river_tile = self[nx, ny]
-                    river_edges += [i for i in range(4)
-                                    if river_tile.edges[i] == RIVER
-                                    and not i == nedge]
-                else:
-                    break
-
-            if len(set(river_edges + [i for i in range(4)
-                                      if tile.edges[i] == RIVER
-                                      and not i == nedge])) > 2:
+            if self.river_head is None:
+                return False
+            exits = self.river_edges
+            for i in range(4):
+                if edges[i] == RIVER and not i == self.river_head[2]:
+                    exits |= 1 << i
+            if bin(exits).count('1') > 2:
                 return False
         return True
 
-    def place(self, tile, x, y):
+    def place(self, tiletype, x, y, undoable=False):
+        """
+        Place a tile of the given type at (x, y), returning the list of new
+        (possibly merged) features on it.
+
+        If undoable is set, returns (features, token) instead, where the token
+        can be passed to undo to revert the placement.
+        """
+        token = len(self.journal)
+        if undoable:
+            self.journalling = True
+        tile = PlacedTile(tiletype, x, y, self)
         self.tiles[(x, y)] = tile
-        return tile.place(x, y, self)
+        self.zobrist ^= zobrist_key(1, tiletype.zobrist, x, y)
+        if self.board is not None:
+            self.board.set_tile(x, y, tiletype.edges)
+        self.record('tile', x, y)
+        added = []
+        for i in range(4):
+            nx, ny, _ = self.adjacent_edge(x, y, i)
+            if not self[nx, ny] and (nx, ny) not in self.frontier:
+                self.frontier.add((nx, ny))
+                added.append((nx, ny))
+        self.record('frontier', x, y, (x, y) in self.frontier, added)
+        self.frontier.discard((x, y))
+        if RIVER in tiletype.edges:
+            self.record('river', self.river_head, self.river_edges)
+            self.extend_river(tiletype, x, y)
+        features = tile.place()
+        self.count_neighbours(tile)
+        if RIVER in tiletype.edges:
+            #the river head has moved, which may affect any cell
+            cells = list(self.frontier) + [(x, y)]
+        else:
+            cells = [(x, y)] + [self.adjacent_edge(x, y, i)[:2] for i in range(4)]
+        for xy in cells:
+            self.update_cell(xy)
+        if undoable:
+            return features, token
+        return features
+
+    def record(self, *entry):
+        "Add an entry to the undo journal, if an undoable placement is active."
+        if self.journalling:
+            self.journal.append(entry)
+
+    def undo(self, token):
+        """
+        Revert the world to the state it was in before the undoable placement
+        which returned token.
+        """
+        while len(self.journal) > token:
+            entry = self.journal.pop()
+            getattr(self, '_undo_' + entry[0])(*entry[1:])
+        self.journalling = bool(self.journal)
+
+    def _undo_tile(self, x, y):
+        self.zobrist ^= zobrist_key(1, self.tiles[(x, y)].type.zobrist, x, y)
+        del self.tiles[(x, y)]
+        if self.board is not None:
+            self.board.clear_tile(x, y)
+
+    def _undo_frontier(self, x, y, frontier, added):
+        for xy in added:
+            self.frontier.discard(xy)
+        if frontier:
+            self.frontier.add((x, y))
+
+    def _undo_river(self, head, edges):
+        self.river_head = head
+        self.river_edges = edges
+
+    def _undo_merge(self, feature, other, state, other_state):
+        if other.parent is feature:
+            feature.unmerge(other, state)
+        else:
+            other.unmerge(feature, other_state)
+
+    def _undo_parent(self, feature, parent):
+        feature.parent = parent
+
+    def _undo_claim(self, avatar, feature, key):
+        feature.unclaim()
+        avatar.segment = None
+        self.zobrist ^= key
+
+    def _undo_complete_city(self, city):
+        for farm in city.farms.values():
+            farm.complete_cities -= 1
+
+    def _undo_cloister(self, x, y):
+        del self.cloisters[(x, y)]
+
+    def _undo_neighbour(self, cloister):
+        cloister.neighbours -= 1
+
+    def _undo_fits(self, xy, fits):
+        self._set_fits(xy, self.fits.get(xy), fits)
+
+    def _undo_dead(self, xy, dead):
+        if dead:
+            self.dead.add(xy)
+        else:
+            self.dead.discard(xy)
+
+    def _undo_stack(self, edges, count, remaining_edges, legal):
+        if count:
+            self.remaining[edges] = count
+        else:
+            del self.remaining[edges]
+        self.remaining_edges = remaining_edges
+        if legal is None:
+            del self.legal[edges]
+        else:
+            self.legal[edges] = legal
+
+    def _undo_open_edge(self, key, segment):
+        self._set_open_edge(key, self.open_edges.get(key), segment)
+
+    def _undo_remove_feature(self, feature, slot):
+        self.features.restore(feature, slot)
+
+    def _undo_defer_farms(self):
+        self.pending_farms.pop()
+
+    def _undo_resolve_farms(self, pending):
+        self.pending_farms = pending
+
+    def _undo_replace_feature(self, feature, root):
+        self.features.replace(root, feature)
+
+    def _undo_add_features(self, features):
+        for feature in reversed(features):
+            self.features.pop()
+
+    def set_open_edge(self, key, segment):
+        """
+        Record that the segment owns the open edge key, or that the edge has
+        been closed if segment is None, keeping the open edge counts of the
+        owning features up to date.
+        """
+        old = self.open_edges.get(key)
+        self.record('open_edge', key, old)
+        self._set_open_edge(key, old, segment)
+
+    def _set_open_edge(self, key, old, segment):
+        if old is not None:
+            old.feature.open_count -= 1
+        if segment is None:
+            del self.open_edges[key]
+        else:
+            self.open_edges[key] = segment
+            segment.feature.open_count += 1
+
+    def complete_city(self, city):
+        "Count a newly completed city on the farms bordering it."
+        for farm in city.farms.values():
+            farm.complete_cities += 1
+        self.record('complete_city', city)
+
+    def claim(self, player, segment, big=False, small=False):
+        """
+        Have the player claim the feature a segment (on the tile just placed)
+        belongs to with one of their avatars, which is put on that segment,
+        updating the hash. Returns the avatar used.
+
+        The hash key is for the segment claimed, rather than one picked from
+        the feature, whose order depends on the order of the merges.
+        """
+        feature = segment.feature
+        avatar = player.claim(segment, big, small)
+        key = zobrist_key(2, player.index, avatar.big, segment.tile.x,
+                          segment.tile.y, segment.tile.segments.index(segment))
+        self.zobrist ^= key
+        self.record('claim', avatar, feature, key)
+        return avatar
+
+    def cell_fits(self, x, y):
+        "Return the :class:`CellFits` for the empty cell (x, y)."
+        if abs(x) >= self.extent or abs(y) >= self.extent:
+            return NO_FITS
+        fits, river = constraint_fits(self.constraint(x, y))
+        allowed = tuple((e, r) for (e, r) in river
+                        if self.river_allowed(rotate_edges(e, r), x, y))
+        if allowed:
+            fits = CellFits(fits.moves + allowed)
+        return fits
+
+    def update_cell(self, xy):
+        "Bring the fits, legal and dead entries for a cell up to date."
+        old = self.fits.get(xy)
+        fits = self.cell_fits(*xy) if xy in self.frontier else None
+        if fits is None or old is None:
+            changed = fits is not old
+        else:
+            changed = fits is not old and not fits.moves == old.moves
+        if changed:
+            self.record('fits', xy, old)
+            self._set_fits(xy, old, fits)
+        self.update_dead(xy)
+
+    def _set_fits(self, xy, old, fits):
+        if fits is None:
+            del self.fits[xy]
+        else:
+            self.fits[xy] = fits
+        #the legal placements are kept for exactly the remaining base tuples
+        remaining = self.remaining_edges
+        if remaining is None:
+            return
+        x, y = xy
+        if old is not None:
+            for e, r in old.moves:
+                if e in remaining:
+                    self.legal[e].discard((x, y, r))
+        if fits is not None:
+            for e, r in fits.moves:
+                if e in remaining:
+                    self.legal[e].add((x, y, r))
+
+    def update_dead(self, xy):
+        fits = self.fits.get(xy)
+        if fits is None:
+            dead = False
+        elif self.remaining_edges is None:
+            dead = not fits.moves
+        else:
+            dead = fits.edges.isdisjoint(self.remaining_edges)
+        if not dead == (xy in self.dead):
+            self.record('dead', xy, not dead)
+            if dead:
+                self.dead.add(xy)
+            else:
+                self.dead.discard(xy)
+
+    def set_stack(self, stack):
+        """
+        Tell the world which tiles are left in the stack, so that it can keep
+        track of the dead cells. Game calls draw to keep this up to date.
+        """
+        self.remaining = {}
+        for tile in stack:
+            edges = canonical_edges(tile.edges)[0]
+            self.remaining[edges] = self.remaining.get(edges, 0) + 1
+        self.remaining_edges = frozenset(self.remaining)
+        self.legal = {}
+        for edges in self.remaining:
+            self.legal[edges] = self.legal_placements(edges)
+        for xy in self.fits:
+            self.update_dead(xy)
+
+    def legal_placements(self, edges):
+        "Work out the set of legal (x, y, rotation) for a base tuple afresh."
+        result = set()
+        for (x, y), fits in self.fits.items():
+            for e, r in fits.moves:
+                if e == edges:
+                    result.add((x, y, r))
+        return result
+
+    def draw(self, tile, count=-1):
+        """
+        Note that a tile has been taken from the stack, or returned to it if
+        count is positive.
+        """
+        if self.remaining is None:
+            return
+        edges = canonical_edges(tile.edges)[0]
+        old = self.remaining.get(edges, 0)
+        self.record('stack', edges, old, self.remaining_edges,
+                    self.legal.get(edges))
+        if old + count:
+            self.remaining[edges] = old + count
+        else:
+            del self.remaining[edges]
+        if not old or not old + count:
+            #a type has run out or come back, which may kill or revive cells
+            if old:
+                del self.legal[edges]
+            else:
+                self.legal[edges] = self.legal_placements(edges)
+            self.remaining_edges = frozenset(self.remaining)
+            for xy in list(self.fits):
+                self.update_dead(xy)
+
+    def placeable(self, tile):
+        "Test whether the tile can be placed anywhere, without listing where."
+        if not self.tiles:
+            return True
+        if self.board is not None:
+            return bool(self.board_placements(tile))
+        edges = canonical_edges(tile.edges)[0]
+        if edges in self.legal:
+            return bool(self.legal[edges])
+        return any(edges in fits.edges for fits in self.fits.values())
+
+    def count_neighbours(self, tile):
+        """
+        Register any cloister on a newly placed tile, and bump the neighbour
+        counts of the cloisters around it.
+        """
+        x, y = tile.x, tile.y
+        for seg in tile.segments:
+            if seg.feature.is_cloister():
+                cloister = seg.feature
+                cloister.neighbours = sum(1 for i in (-1, 0, 1)
+                                          for j in (-1, 0, 1)
+                                          if self[x+i, y+j])
+                self.cloisters[(x, y)] = cloister
+                self.record('cloister', x, y)
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                cloister = self.cloisters.get((x+i, y+j))
+                if cloister and (i or j):
+                    cloister.neighbours += 1
+                    self.record('neighbour', cloister)
+
+    def touched_features(self, x, y):
+        """
+        Return the features whose state could have changed when the tile at
+        (x, y) was placed: those on the tile itself (which any feature it
+        closed an edge of has been merged into) and the cloisters around it.
+        """
+        result = []
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                cloister = self.cloisters.get((x+i, y+j))
+                if cloister and (i or j):
+                    result.append(cloister)
+        for seg in self[x, y].segments:
+            feature = seg.feature
+            if not any(feature is f for f in result):
+                result.append(feature)
+        return result
+
+    def add_features(self, features):
+        "Add newly created features to the global list."
+        if not self.journal:
+            #nothing can restore a removed feature, so drop the empty slots
+            #once they outnumber the features
+            if len(self.features.slots) > 2 * len(self.features) + 16:
+                self.features.compact()
+        for feature in features:
+            self.features.add(feature)
+        self.record('add_features', tuple(features))
+
+    def defer_farms(self, farms):
+        "Leave the new farms on a tile to be merged by resolve_farms."
+        self.pending_farms.append(farms)
+        self.record('defer_farms')
+
+    def resolve_farms(self, features=None):
+        """
+        Merge any farms left unmerged by the lazy-farms option, in the order
+        their tiles were placed, which builds the same farms as merging them
+        straight away. Anything reading farms, or claiming one, has to call
+        this first; the farm methods do so themselves.
+
+        If a list of features is given, returns it with each replaced by the
+        feature it is now part of, as for place.
+        """
+        if self.pending_farms:
+            pending = self.pending_farms
+            self.pending_farms = []
+            self.record('resolve_farms', pending)
+            for farms in pending:
+                for farm in farms:
+                    farm.segments[0].tile.merge_feature(farm)
+                #as in place, each farm which survives does so in the slot of
+                #the last one on its tile which was merged into it
+                roots = [farm.find() for farm in farms]
+                for i, farm in enumerate(farms):
+                    if farm not in self.features:
+                        continue
+                    elif any(roots[i] is r for r in roots[i + 1:]):
+                        self.remove_feature(farm)
+                    elif roots[i] is not farm:
+                        self.replace_feature(farm, roots[i])
+        if features is not None:
+            roots = [feature.find() for feature in features]
+            return [root for i, root in enumerate(roots)
+                    if not any(root is r for r in roots[i + 1:])]
+
+    def remove_feature(self, feature):
+        "Remove a feature (which has been merged into another) from the list."
+        slot = self.features.remove(feature)
+        self.record('remove_feature', feature, slot)
+
+    def replace_feature(self, feature, root):
+        "Put the feature a farm was merged into in the list in its place."
+        self.features.replace(feature, root)
+        self.record('replace_feature', feature, root)
+
+    def extend_river(self, tile, x, y):
+        """
+        Update the river head and flow directions after placing a river tile.
+        """
+        river_edges = [i for i in range(4) if tile.edges[i] == RIVER]
+        if not self.river_edges:
+            #the source; flows away along its last river edge
+            exits = river_edges
+        else:
+            exits = [i for i in river_edges if not i == self.river_head[2]]
+        for i in exits:
+            self.river_edges |= 1 << i
+        if exits:
+            self.river_head = self.adjacent_edge(x, y, exits[-1])
+        else:
+            self.river_head = None
 
     def possible_placements(self, tile):
         """
@@ -389,31 +1139,157 @@ class World(object):
 
         def _try(tile, i, j):
             result = []
-            for r in range(4):
-                if r < tile.symmetry and self.can_place(tile, i, j):
+            if abs(i) >= self.extent or abs(j) >= self.extent:
+                return result
+            constraint = self.constraint(i, j)
+            for r in range(tile.symmetry):
+                if compatible(tile.edges, r, constraint) and \
+                   self.river_allowed(rotate_edges(tile.edges, r), i, j):
                     result.append((i, j, r))
-                tile = tile.rotate(1)
             return result
 
         if not self.tiles:
             return [(0,0,0)]
 
+        if self.board is not None:
+            return sorted(self.board_placements(tile))
+
+        edges, offset = canonical_edges(tile.edges)
+        if edges in self.legal:
+            #the rotations are of the base tuple, so take off the offset
+            return sorted((x, y, (r - offset) % tile.symmetry)
+                          for (x, y, r) in self.legal[edges])
+
+        result = []
+        for (x, y) in self.frontier:
+            result += _try(tile, x, y)
+
+        return sorted(result)
+
+    def board_placements(self, tile):
+        """
+        Returns the unsorted list of (x, y, rotation) values where the tile
+        could be placed, checking the whole frontier at once on the array
+        board.
+        """
+        cells = [(i, j) for (i, j) in self.frontier
+                 if abs(i) < self.extent and abs(j) < self.extent]
+        result = self.board.placements(cells, tile.edges, tile.symmetry)
+        if RIVER in tile.edges:
+            result = [(i, j, r) for (i, j, r) in result
+                      if self.river_allowed(rotate_edges(tile.edges, r), i, j)]
+        return result
+
+    def placement_classes(self, tile, placements):
+        """
+        Group placements of a tile into classes with identical effects, as
+        described by placement_effects. Returns a list of the classes, each a
+        list of placements in the order given, so that the first of each can
+        be evaluated in place of the rest.
+        """
+        classes = {}
         result = []
-        for (x,y) in self.tiles:
-            if not self[x+1, y]:
-                result += _try(tile, x+1, y)
-            if not self[x, y+1]:
-                result += _try(tile, x, y+1)
-            if not self[x-1, y]:
-                result += _try(tile, x-1, y)
-            if not self[x, y-1]:
-                result += _try(tile, x, y-1)
-
-        return sorted(set(result))
+        self.resolve_farms()
+        for (x, y, r) in placements:
+            key = self.placement_effects(tile.rotate(r), x, y)
+            if key not in classes:
+                classes[key] = []
+                result.append(classes[key])
+            classes[key].append((x, y, r))
+        return result
+
+    def placement_effects(self, tiletype, x, y):
+        """
+        Describe what placing a tile of the given (rotated) type at (x, y)
+        would do, without placing it. Each segment of the tile is described by
+        its kind, pennant, cathedral and inn, the features (by uid) it would
+        merge with through the open edge index, as in PlacedTile.merge_feature,
+        and the number of its edges left open; each farm segment also by the
+        descriptions of the city segments it borders. Along with the cloisters
+        around the cell (and the neighbours a cloister on the tile would
+        have), these decide the merges made and the scores, owners and
+        completion state left behind, whichever the cell and rotation.
+        """
+        segments = segment_layout(tiletype)
+        descriptions = []
+        for seg in segments:
+            feature = seg.feature
+            merges = []
+            open_count = 0
+            for edge in seg.edges:
+                if edge == 8:
+                    continue
+                key = (feature.name,) + feature.normalise_edge(x, y, edge)
+                other = self.open_edges.get(key)
+                if other is None:
+                    open_count += 1
+                else:
+                    merges.append(other.feature.uid)
+            descriptions.append((feature.name,
+                                 bool(getattr(seg, 'pennant', False)),
+                                 bool(getattr(seg, 'cathedral', False)),
+                                 bool(getattr(seg, 'inn', False)),
+                                 tuple(sorted(merges)), open_count))
+        cities = [d for seg, d in zip(segments, descriptions)
+                  if isinstance(seg, CitySegment)]
+        effects = []
+        for seg, description in zip(segments, descriptions):
+            if isinstance(seg, FarmSegment):
+                description += (tuple(sorted(cities[i]
+                                             for i in seg.city_segments)), )
+            effects.append(description)
+        cloisters = []
+        neighbours = 1
+        for i in (-1, 0, 1):
+            for j in (-1, 0, 1):
+                if (i or j) and self[x+i, y+j]:
+                    neighbours += 1
+                    if (x+i, y+j) in self.cloisters:
+                        cloisters.append(self.cloisters[(x+i, y+j)].uid)
+        return (tuple(sorted(effects)), tuple(sorted(cloisters)),
+                neighbours if tiletype.centre & CLOISTER else None)
+
+    def __deepcopy__(self, memo):
+        """
+        Copy the world, for a deepcopied sandbox. The tiles, segments and
+        features form one large graph, which the default deepcopy would walk
+        recursively, overflowing the stack on a full board. Instead an empty
+        copy of each is made up front, so that copying their attributes only
+        ever meets objects which have already been copied.
+        """
+        world = World.__new__(World)
+        memo[id(self)] = world
+        #the tiles first, since features key dictionaries on their tiles
+        for tile in self.tiles.values():
+            copied = PlacedTile.__new__(PlacedTile)
+            copied.type = tile.type
+            copied.x = tile.x
+            copied.y = tile.y
+            copied.world = world
+            copied.views = None
+            memo[id(tile)] = copied
+        #every feature is the one some segment was created in
+        originals = []
+        for tile in self.tiles.values():
+            for seg in tile.segments:
+                for obj in (seg, seg._feature):
+                    if id(obj) not in memo:
+                        memo[id(obj)] = object.__new__(type(obj))
+                        originals.append(obj)
+        for tile in self.tiles.values():
+            memo[id(tile)].segments = [memo[id(seg)] for seg in tile.segments]
+        for obj in originals:
+            memo[id(obj)].__dict__.update(copy.deepcopy(obj.__dict__, memo))
+        world.__dict__.update(copy.deepcopy(self.__dict__, memo))
+        return world
 
     def clone(self):
         #return pickle.loads(pickle.dumps(self))
 
+        #sandboxes are for reading the world, so merge any pending farms once
+        #here rather than in every sandbox
+        self.resolve_farms()
+
         if self.proxify:
             return proxify(self) #faster with cpython
         else:
@@ -423,13 +1299,8 @@ class World(object):
         """
         Test whether a tile exists in stack that can be placed at (x, y).
         """
-        for tile in set(stack):
-            tile = copy.deepcopy(tile)
-            for r in range(4):
-                if r < tile.symmetry and self.can_place(tile, x, y):
-                    return True
-                tile = tile.rotate(1)
-        return False
+        return not self.cell_fits(x, y).edges.isdisjoint(
+            canonical_edges(tile.edges)[0] for tile in stack)
 
 
 
@@ -440,7 +1311,8 @@ class Player(object):
     This is detached from the class representing the human/ai interface.
     Comparison of the two should be done by comparing the index value.
 
-    TODO: Have an avatar class rather than a list of claims.
+    The avatars keep the player's counts of free small and big avatars, and
+    the list of those in play, up to date as they are placed and lifted.
     """
     def __init__(self, index, playertype, avatars=7, big_avatars=1):
         self.index = index
@@ -448,20 +1320,24 @@ class Player(object):
         self.playertype = playertype
         self.colour = index + 1
         self.avatars = [Avatar(self) for i in range(avatars)] + [BigAvatar(self) for i in range(big_avatars)]
+        self.free_small = avatars
+        self.free_big = big_avatars
+        self.placed = []
         self.completed = []
         self.score = 0
 
     def features(self):
-        return [a.segment.feature for a in self.avatars if not a.available]
+        "Return the features claimed by the avatars in play."
+        return [a.segment.feature for a in self.placed]
     
     def available(self, big=False, small=False):
         "Return the number of available avatars (of the specified type)."
         if big == small:
-            return sum(1 for a in self.avatars if a.available())
+            return self.free_small + self.free_big
         elif big:
-            return sum(1 for a in self.avatars if a.available() and a.big)
+            return self.free_big
         elif small:
-            return sum(1 for a in self.avatars if a.available() and not a.big)
+            return self.free_small
 
     def __repr__(self):
         return "<Player %s: %s>" % (self.index, self.name)
@@ -503,20 +1379,43 @@ class Player(object):
                         return a
         assert True, "Unreachable"
     
-    def claim(self, feature, big=False, small=False):
+    def claim(self, segment, big=False, small=False):
+        "Claim the feature of a segment, returning the avatar put on it."
         avatar = self.get_avatar(big, small)
-        feature.claim(avatar)
-        avatar.segment = feature.segments[-1]
+        segment.feature.claim(avatar)
+        avatar.segment = segment
+        return avatar
         
 class Avatar(object):
     strength = 1
     big = False
     def __init__(self, player):
         self.player = player
-        self.segment = None
+        self._segment = None
+
+    @property
+    def segment(self):
+        "The segment the avatar is placed on, or None when it is free."
+        return self._segment
+
+    @segment.setter
+    def segment(self, segment):
+        if (self._segment is None) != (segment is None):
+            player = self.player
+            if segment is None:
+                player.placed.remove(self)
+                change = 1
+            else:
+                player.placed.append(self)
+                change = -1
+            if self.big:
+                player.free_big += change
+            else:
+                player.free_small += change
+        self._segment = segment
     
     def available(self):
-        return self.segment == None
+        return self._segment is None
         
     def feature(self):
         return None if self.segment == None else self.segment.feature